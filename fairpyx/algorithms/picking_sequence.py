@@ -7,7 +7,8 @@ Programmer: Erel Segal-Halevi
 Since: 2023-06
 """
 
-from itertools import cycle
+from collections import deque
+import heapq
 from fairpyx import Instance, AllocationBuilder
 
 import logging
@@ -27,20 +28,50 @@ def picking_sequence(alloc: AllocationBuilder, agent_order:list):
     >>> instance = Instance(agent_capacities=agent_capacities, item_capacities=course_capacities, valuations=valuations)
     >>> divide(picking_sequence, instance=instance, agent_order=["Alice","Bob", "Chana", "Dana","Dana","Chana","Bob", "Alice"])
     {'Alice': ['c1', 'c3'], 'Bob': ['c1', 'c2', 'c3'], 'Chana': ['c2', 'c3'], 'Dana': ['c2', 'c3']}
+
+    # Ties between equally-valued items are broken in favor of the item that comes first:
+    >>> valuations = {"Alice": {"c1": 5, "c2": 5, "c3": 5}, "Bob": {"c1": 5, "c2": 5, "c3": 5}}
+    >>> instance = Instance(agent_capacities={"Alice": 1, "Bob": 1}, item_capacities={"c1": 1, "c2": 1, "c3": 1}, valuations=valuations)
+    >>> divide(picking_sequence, instance=instance, agent_order=["Alice","Bob"])
+    {'Alice': ['c1'], 'Bob': ['c2']}
+
+    # Agents that do not appear in the picking sequence do not pick; the algorithm stops once all agents in the sequence are done:
+    >>> divide(picking_sequence, instance=instance, agent_order=["Alice"])
+    {'Alice': ['c1'], 'Bob': []}
     """
     logger.info("\nPicking-sequence with items %s , agents %s, and agent-order %s", alloc.remaining_item_capacities, alloc.remaining_agent_capacities, agent_order)
-    for agent in cycle(agent_order):
-        if alloc.isdone():
-            break 
+    items = list(alloc.remaining_items())   # items are referred to by their index in this list.
+    item_heaps = {}   # maps each agent to a max-heap of (-value, item-index) over its potential items; built on the agent's first turn.
+    # The turns of agents that can still pick, in cyclic order; the turns of agents that are done are dropped.
+    remaining_turns = deque(agent_order)
+    while len(remaining_turns)>0 and not alloc.isdone():
+        agent = remaining_turns.popleft()
         if not agent in alloc.remaining_agent_capacities:
             continue
-        potential_items_for_agent = set(alloc.remaining_items_for_agent(agent))
-        if len(potential_items_for_agent)==0:
+        if agent not in item_heaps:
+            item_heaps[agent] = [(-alloc.effective_value(agent,item), index) for index,item in enumerate(items) if _is_potential_item(alloc, agent, item)]
+            heapq.heapify(item_heaps[agent])
+        heap = item_heaps[agent]
+        # Lazily discard items that were exhausted or became conflicting since the heap was built:
+        while len(heap)>0 and not _is_potential_item(alloc, agent, items[heap[0][1]]):
+            heapq.heappop(heap)
+        if len(heap)==0:
             logger.info("Agent %s cannot pick any more items: remaining=%s, bundle=%s", agent, alloc.remaining_item_capacities, alloc.bundles[agent])
             alloc.remove_agent_from_loop(agent)
             continue
-        best_item_for_agent = max(potential_items_for_agent, key=lambda item: alloc.effective_value(agent,item))
+        (_, best_item_index) = heapq.heappop(heap)
+        best_item_for_agent = items[best_item_index]
         alloc.give(agent, best_item_for_agent, logger)
+        if agent in alloc.remaining_agent_capacities:
+            remaining_turns.append(agent)
+
+
+def _is_potential_item(alloc: AllocationBuilder, agent, item)->bool:
+    """
+    Return True if the item has remaining capacity and the agent may still take it.
+    Since items are never returned and conflicts are never removed, once this becomes False it remains False.
+    """
+    return item in alloc.remaining_item_capacities and (agent,item) not in alloc.remaining_conflicts
 
 
 def serial_dictatorship(alloc: AllocationBuilder, agent_order:list=None):